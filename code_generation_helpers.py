@@ -1,3 +1,127 @@
+import functools
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+# parallel loop headers, formatted with the index variable (v) and the loop bound (m)
+_LOOP_TGRP = "for(int {v} = tgrp.thread_rank(); {v} < {m}; {v} += tgrp.size()){{"
+_LOOP_THREAD = "for(int {v} = _thr_base; {v} < {m}; {v} += _thr_stride){{"
+_LOOP_BLOCK = "for(int {v} = _grid_base; {v} < {m}; {v} += _grid_stride){{"
+
+# start and stride of the thread and block level loops, declared once per scope before the first loop that uses them
+_HOIST_THREAD = ["const int _thr_base = threadIdx.x + threadIdx.y*blockDim.x;", "const int _thr_stride = blockDim.x*blockDim.y;"]
+_HOIST_BLOCK = ["const int _grid_base = blockIdx.x + blockIdx.y*gridDim.x;", "const int _grid_stride = gridDim.x*gridDim.y;"]
+
+# compiled cubins are cached here, keyed by a hash of the generated code, the nvcc binary and its arguments
+CACHE_DIR = os.environ.get("GRID_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "grid_less"))
+
+# integer options that can be collapsed into ranges (no octal, hex, digit separators or whitespace)
+_DECIMAL_LITERAL = re.compile(r"-?(0|[1-9][0-9]*)")
+
+# when at least this many options are left over after collapsing ranges they are tested with a switch
+_SWITCH_MIN_CASES = 8
+
+def gen_init_code(self):
+    """initializes the buffer that the grid.cuh code is built up in; call this once (ex. in __init__)
+    before adding any code. Lines are kept as a list of strings and only joined together in get_code()
+
+    The following options can be changed after this call:
+
+    * self.debug_prints: add the print_shared() debugging code, defaults to False
+    * self.arch: GPU architecture finalize() compiles for (ex. "sm_80"), defaults to None
+    * self.use_async_copy: make the gen_kernel_load_inputs helpers copy global to shared memory with cp.async
+      (__pipeline_memcpy_async, hardware accelerated on sm_80+). The generated file must #include <cuda_pipeline.h>.
+      Each load waits on its copies right after issuing them, so this skips the trip through registers but does
+      not overlap the copy with other work. Defaults to False
+    """
+    self.code_chunks = []
+    self.indent_level = 0
+    self._indent_prefix = ""
+    self._select_count = 0
+    self._hoisted_bases = {}
+    self.debug_prints = False
+    self.arch = None
+    self.use_async_copy = False
+
+def get_code(self):
+    """returns all of the CUDA C++ code added so far as a single python string (use write() to save it to a file)
+
+    :return: the contents of the grid.cuh file
+    :rtype: string
+    """
+    return "".join(self.code_chunks)
+
+def write(self, path):
+    """writes all of the CUDA C++ code added so far to a file (ex. grid.cuh), streaming the buffered lines
+    straight to disk rather than joining them into one string first
+
+    :param path: path of the file to write
+    :type path: string
+    """
+    with open(path, "w", buffering = 1 << 20) as code_file:
+        code_file.writelines(self.code_chunks)
+
+def finalize(self, arch = None, nvcc_flags = [], cache_dir = None):
+    """compiles the generated code to a cubin with nvcc, reusing a cached cubin if the exact same code was
+    already compiled with the same arguments
+
+    :param arch: GPU architecture to compile for, defaults to self.arch or "sm_70" if that is not set
+    :type arch: string, optional
+    :param nvcc_flags: extra flags to pass to nvcc (ex. ["-I/path/to/include"]), defaults to []
+    :type nvcc_flags: list, optional
+    :param cache_dir: directory of the cubin cache, defaults to CACHE_DIR
+    :type cache_dir: string, optional
+    :return: path to the compiled cubin, or None if nvcc could not be found or run, or failed
+    :rtype: string
+    """
+    if arch is None:
+        arch = self.arch or "sm_70"
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    nvcc = shutil.which("nvcc")
+    if nvcc is None:
+        print("![ERROR]: NVCC NOT FOUND ON PATH")
+        return None
+    nvcc = os.path.realpath(nvcc)
+    src = self.get_code()
+    args = ["-cubin", "-arch=" + arch] + list(nvcc_flags)
+    # the resolved nvcc binary and its modification time are part of the key so a toolkit upgrade misses the cache
+    key = hashlib.sha256("\0".join([src, nvcc, str(os.stat(nvcc).st_mtime_ns)] + args).encode()).hexdigest()
+    cubin_path = os.path.join(cache_dir, key + ".cubin")
+    if os.path.exists(cubin_path):
+        return cubin_path
+    os.makedirs(cache_dir, exist_ok = True)
+    with tempfile.TemporaryDirectory(dir = cache_dir) as tmp_dir:
+        src_path = os.path.join(tmp_dir, "grid.cu")
+        tmp_cubin_path = os.path.join(tmp_dir, "grid.cubin")
+        with open(src_path, "w") as src_file:
+            src_file.write(src)
+        try:
+            result = subprocess.run([nvcc] + args + ["-o", tmp_cubin_path, src_path], capture_output = True, text = True)
+        except OSError as e:
+            print("![ERROR]: COULD NOT RUN NVCC\n" + str(e))
+            return None
+        if result.returncode != 0:
+            print("![ERROR]: NVCC FAILED\n" + result.stderr)
+            return None
+        # move into place only once complete so a failed or concurrent build never leaves a partial cubin
+        os.replace(tmp_cubin_path, cubin_path)
+    return cubin_path
+
+def _indent(self):
+    self.indent_level += 1
+    self._indent_prefix += "    "
+
+def _dedent(self):
+    self.indent_level -= 1
+    self._indent_prefix = self._indent_prefix[:-4]
+    # closing the block a loop base was declared in takes it out of scope
+    if self._hoisted_bases:
+        self._hoisted_bases = {kind: level for (kind, level) in self._hoisted_bases.items() if level <= self.indent_level}
+
 def gen_add_code_line(self, new_code_line, add_indent_after = False):
     """add a single line of CUDA C++ code to the grid.cuh file
 
@@ -6,9 +130,9 @@ def gen_add_code_line(self, new_code_line, add_indent_after = False):
     :param add_indent_after: set to true if code line is the beginning of a block and requires the subsequent line to be indented (ex. if(){ ), defaults to False
     :type add_indent_after: bool, optional
     """
-    self.code_str += self.indent_level * "    " + new_code_line + "\n"
+    self.code_chunks.append(f"{self._indent_prefix}{new_code_line}\n")
     if add_indent_after:
-        self.indent_level += 1
+        _indent(self)
 
 def gen_add_code_lines(self, new_code_lines, add_indent_after = False):
     """add multiple lines of CUDA C++ code to the grid.cuh file
@@ -18,21 +142,21 @@ def gen_add_code_lines(self, new_code_lines, add_indent_after = False):
     :param add_indent_after: set to true if the last code line is the beginning of a block and requires the subsequent line to be indented (ex. if(){ ), defaults to False
     :type add_indent_after: bool, optional
     """
-    for new_code_line in new_code_lines:
-        self.gen_add_code_line(new_code_line)
+    prefix = self._indent_prefix
+    self.code_chunks.extend(f"{prefix}{new_code_line}\n" for new_code_line in new_code_lines)
     if add_indent_after:
-        self.indent_level += 1
+        _indent(self)
 
 def gen_add_end_control_flow(self):
     """used at the end of a block of code; adds a closing bracket and unindents 
     """
-    self.indent_level -= 1
+    _dedent(self)
     self.gen_add_code_line("}")
 
 def gen_add_end_function(self):
     """used at the end of a function; adds a closing bracket, unindents, and adds a newline 
     """
-    self.indent_level -= 1
+    _dedent(self)
     self.gen_add_code_line("}\n")
 
 def gen_add_func_doc(self, func_desc, notes = [], params = [], return_val = None):
@@ -47,19 +171,17 @@ def gen_add_func_doc(self, func_desc, notes = [], params = [], return_val = None
     :param return_val: name of the value to be returned, defaults to None
     :type return_val: string, optional
     """
-    self.gen_add_code_line("/**")
-    self.gen_add_code_line(" * " + func_desc)
-    self.gen_add_code_line(" *")
+    p = self._indent_prefix
+    parts = [f"{p}/**\n", f"{p} * {func_desc}\n", f"{p} *\n"]
     if len(notes) > 0:
-        self.gen_add_code_line(" * Notes:")
-        for note in notes:
-            self.gen_add_code_line(" *   " + note)
-        self.gen_add_code_line(" *")
-    for param in params:
-        self.gen_add_code_line(" * @param " + param)
+        parts.append(f"{p} * Notes:\n")
+        parts.extend(f"{p} *   {note}\n" for note in notes)
+        parts.append(f"{p} *\n")
+    parts.extend(f"{p} * @param {param}\n" for param in params)
     if return_val is not None:
-        self.gen_add_code_line(" * @return " + return_val)
-    self.gen_add_code_line(" */")
+        parts.append(f"{p} * @return {return_val}\n")
+    parts.append(f"{p} */\n")
+    self.code_chunks.extend(parts)
 
 def gen_add_serial_ops(self, use_thread_group = False):
     """
@@ -76,6 +198,34 @@ def gen_add_serial_ops(self, use_thread_group = False):
     else:
         self.gen_add_code_line("if(threadIdx.x == 0 && threadIdx.y == 0){", True)
 
+def gen_add_multi_thread_init(self, count, use_thread_group = False):
+    """
+    Use in place of gen_add_serial_ops() when the block of code initializes count independent slots: the first
+    count threads each run it (use the thread index to pick the slot) instead of one thread doing all of them.
+
+    note: gen_add_multi_thread_init() opens a parenthesis. After all the code has been added, call
+    gen_add_end_control_flow() to close the parenthesis and gen_add_sync() before the slots are read.
+
+    :param count: number of threads to run the block of code on (ex. str(6))
+    :type count: string
+    :param use_thread_group: index threads within the thread group, defaults to False
+    :type use_thread_group: bool, optional
+    """
+    if use_thread_group:
+        self.gen_add_code_line("if(tgrp.thread_rank() < " + str(count) + "){", True)
+    else:
+        self.gen_add_code_line("if((int)(threadIdx.x + threadIdx.y*blockDim.x) < " + str(count) + "){", True)
+
+@functools.lru_cache(maxsize=None)
+def _parallel_loop_header(var_name, max_val, use_thread_group, block_level):
+    if block_level:
+        template = _LOOP_BLOCK
+    elif use_thread_group:
+        template = _LOOP_TGRP
+    else:
+        template = _LOOP_THREAD
+    return template.format(v = var_name, m = max_val)
+
 def gen_add_parallel_loop(self, var_name, max_val, use_thread_group = False, block_level = False):
     """call gen_add_parallel_loop() when you are running an operation in parallel. After this call, add
     in the operation. In the subsequent lines, you may need to use var_name to move through your shared memory.
@@ -91,38 +241,86 @@ def gen_add_parallel_loop(self, var_name, max_val, use_thread_group = False, blo
     note: gen_add_parallel_loop() opens a parenthesis. After all the code to be executed in parallel has been added,
     call gen_add_end_control_flow() to close the parenthesis.
     """
-    if block_level:
-        if use_thread_group:
-            print("![ERROR]: BLOCK LEVEL THREAD GROUP LOOP NOT IMPLEMENTED YET")
-        else:
-            code = "for(int " + var_name + " = blockIdx.x + blockIdx.y*gridDim.x; " + \
-                        var_name + " < " + max_val + "; " + var_name + " += gridDim.x*gridDim.y){"
-    else:
-        if use_thread_group:
-            code = "for(int " + var_name + " = tgrp.thread_rank(); " + \
-                        var_name + " < " + max_val + "; " + var_name + " += tgrp.size()){"
-        else:
-            code = "for(int " + var_name + " = threadIdx.x + threadIdx.y*blockDim.x; " + \
-                        var_name + " < " + max_val + "; " + var_name + " += blockDim.x*blockDim.y){"
-    self.gen_add_code_line(code, True)
+    if block_level and use_thread_group:
+        raise NotImplementedError("block level thread group loop not implemented yet")
+    if not use_thread_group:
+        kind = "block" if block_level else "thread"
+        if kind not in self._hoisted_bases:
+            self.gen_add_code_lines(_HOIST_BLOCK if block_level else _HOIST_THREAD)
+            self._hoisted_bases[kind] = self.indent_level
+    self.gen_add_code_line(_parallel_loop_header(var_name, max_val, use_thread_group, block_level), True)
 
 def gen_static_array_ind_2d(self, col, row, col_stride = 6):
+    """returns the flat index of (col, row) in a column-major static array, computed in python so it can be
+    written into the generated code as a constant offset
+
+    :param col: column index
+    :type col: int
+    :param row: row index
+    :type row: int
+    :param col_stride: number of entries in one column, defaults to 6
+    :type col_stride: int, optional
+    :return: flat index
+    :rtype: int
+    """
     return col_stride*col + row
 
 def gen_static_array_ind_3d(self, ind, col, row, ind_stride = 36, col_stride = 6):
+    """returns the flat index of (ind, col, row) in a static array of column-major matrices, computed in python so
+    it can be written into the generated code as a constant offset
+
+    :param ind: matrix index
+    :type ind: int
+    :param col: column index
+    :type col: int
+    :param row: row index
+    :type row: int
+    :param ind_stride: number of entries in one matrix, defaults to 36
+    :type ind_stride: int, optional
+    :param col_stride: number of entries in one column, defaults to 6
+    :type col_stride: int, optional
+    :return: flat index
+    :rtype: int
+    """
     return ind_stride*ind + col_stride*col + row
 
-def gen_add_sync(self, use_thread_group = False):
+def gen_add_sync(self, use_thread_group = False, scope = "block", num_threads = None, barrier_id = 1):
     """after executing a section of code in parallel, some threads might be finished sooner than others. To
     make sure no threads are going past this point until all threads are finished with the parallel operation, 
     gen_add_sync() inserts __syncthreads(), which syncs all the threads in the block. Call this at each step of
-    the algorithm.
+    the algorithm. If the line just added is already the same barrier, no second one is added.
 
+    When only part of the block takes part in the exchange a narrower barrier can be used instead. Only do this
+    when every thread that reads the data was also part of the region that wrote it.
+
+    :param use_thread_group: sync the thread group (tgrp.sync()) instead of the block, defaults to False
+    :type use_thread_group: bool, optional
+    :param scope: "block" for __syncthreads(), "warp" for __syncwarp(), or "named" for a PTX named barrier
+        (bar.sync) over num_threads threads, defaults to "block"
+    :type scope: string, optional
+    :param num_threads: number of threads taking part in a named barrier (a multiple of 32), defaults to None
+    :type num_threads: int, optional
+    :param barrier_id: id of the named barrier to use, 1 to 15 (0 is reserved for __syncthreads()), defaults to 1
+    :type barrier_id: int, optional
     """
     if use_thread_group:
-        self.gen_add_code_line("tgrp.sync();")
+        code = "tgrp.sync();"
+    elif scope == "warp":
+        code = "__syncwarp();"
+    elif scope == "named":
+        if num_threads is None or num_threads <= 0 or num_threads % 32 != 0:
+            print("![ERROR]: NAMED BARRIER REQUIRES num_threads TO BE A POSITIVE MULTIPLE OF 32")
+            return
+        if not 1 <= barrier_id <= 15:
+            print("![ERROR]: NAMED BARRIER REQUIRES barrier_id FROM 1 TO 15 (0 IS USED BY __syncthreads())")
+            return
+        code = "asm volatile(\"bar.sync " + str(barrier_id) + ", " + str(num_threads) + ";\");"
     else:
-        self.gen_add_code_line("__syncthreads();")
+        code = "__syncthreads();"
+    # nothing has happened since an identical barrier was just added, so this one would be redundant
+    if self.code_chunks and self.code_chunks[-1] == f"{self._indent_prefix}{code}\n":
+        return
+    self.gen_add_code_line(code)
 
 #ADDED (IDSVA specific): //extend to print any shared memory
 def print_shared(self, var, ncol, size): #varname, number of columns in one matrix, number of matrices
@@ -135,28 +333,98 @@ def print_shared(self, var, ncol, size): #varname, number of columns in one matr
     :type ncol: int
     :param size: number of matrices of the variable
     :type size: int
+
+    note: nothing is added unless self.debug_prints is set, and the added code is wrapped in #ifdef GRID_DEBUG_PRINT
+    so it is only compiled in when building with -DGRID_DEBUG_PRINT
     """
+    if not self.debug_prints:
+        return
     #s_a, 7, 15; s_b, 6, 28
     content = "for (int i = 0; i < " + str(size) + "; i++) {" +\
             "printf(\"" + var + "[%d]\\n\", i);" +\
             "printMat<T,6," + str(ncol) + ">(&" + var + "[" + str(6 * ncol) + "*i], 6);}"
+    self.gen_add_code_line("#ifdef GRID_DEBUG_PRINT")
     self.gen_add_sync()
     self.gen_add_serial_ops() 
     self.gen_add_code_line(content)
     self.gen_add_end_control_flow()
+    self.gen_add_code_line("#endif")
         
 
+def _option_runs(option_list):
+    # sorted runs [lo, hi] of consecutive values in option_list, or None if an option is not a plain decimal
+    # literal (C++ reads "010" as octal, so only options python and C++ agree on are collapsed)
+    if not all(_DECIMAL_LITERAL.fullmatch(option) for option in option_list):
+        return None
+    values = sorted(set(int(option) for option in option_list))
+    runs = []
+    for value in values:
+        if runs and value == runs[-1][1] + 1:
+            runs[-1][1] = value
+        else:
+            runs.append([value, value])
+    return runs
+
+def _gen_var_list_terms(var_name, option_list, in_list):
+    # returns the tests for an integer option list, or None for non-integer options. Runs of three or more
+    # values become a single range test; if enough single values are left they share one switch instead of
+    # one test each
+    runs = _option_runs(option_list)
+    if runs is None:
+        return None
+    terms = []
+    singles = []
+    for (lo, hi) in runs:
+        if hi - lo >= 2:
+            if in_list:
+                terms.append("(" + var_name + " >= " + str(lo) + " && " + var_name + " <= " + str(hi) + ")")
+            else:
+                terms.append("(" + var_name + " < " + str(lo) + " || " + var_name + " > " + str(hi) + ")")
+        else:
+            singles.extend(range(lo, hi + 1))
+    if len(singles) >= _SWITCH_MIN_CASES:
+        switch = "([&]{switch(" + var_name + "){" + " ".join("case " + str(value) + ":" for value in singles) + \
+                 " return true; default: return false;}}())"
+        terms.append(switch if in_list else "(!" + switch + ")")
+    else:
+        terms.extend("(" + var_name + (" == " if in_list else " != ") + str(value) + ")" for value in singles)
+    return terms
+
 def gen_var_in_list(self, var_name, option_list):
+    """returns a C++ boolean expression that is true when var_name equals one of the options. Integer options are
+    collapsed into range tests where they are consecutive, and many remaining single values become a switch
+    (a jump table for nvcc)
+
+    :param var_name: name of the variable to test
+    :type var_name: string
+    :param option_list: list of values to test against (ex. ["0", "1", "2"])
+    :type option_list: list
+    :return: the boolean expression
+    :rtype: string
+    """
     if len(option_list) == 1:
         return "(" + var_name + " == " + option_list[0] + ")"
-    else:
-        return "(" + " || ".join(["(" + var_name + " == " + option + ")" for option in option_list]) + ")"
+    terms = _gen_var_list_terms(var_name, option_list, True)
+    if terms is None:
+        terms = ["(" + var_name + " == " + option + ")" for option in option_list]
+    return "(" + " || ".join(terms) + ")"
 
 def gen_var_not_in_list(self, var_name, option_list):
+    """returns a C++ boolean expression that is true when var_name equals none of the options (see gen_var_in_list)
+
+    :param var_name: name of the variable to test
+    :type var_name: string
+    :param option_list: list of values to test against (ex. ["0", "1", "2"])
+    :type option_list: list
+    :return: the boolean expression
+    :rtype: string
+    """
     if len(option_list) == 1:
         return "(" + var_name + " != " + option_list[0] + ")"
-    else:
-        return "(" + " && ".join(["(" + var_name + " != " + option + ")" for option in option_list]) + ")"
+    terms = _gen_var_list_terms(var_name, option_list, False)
+    if terms is None:
+        terms = ["(" + var_name + " != " + option + ")" for option in option_list]
+    return "(" + " && ".join(terms) + ")"
 
 def gen_add_multi_threaded_select(self, loop_counter, comparator, counts, select_tuples, USE_NON_BRANCH_ALWAYS = False):
     # first find the resulting type and variable name
@@ -191,74 +459,121 @@ def gen_add_multi_threaded_select(self, loop_counter, comparator, counts, select
     # else use a non-branching selector
     else:
         self.gen_add_code_line("// non-branching pointer selector")
-        # get the inverse comparator
+        # evaluate each comparison once into a predicate shared by every selected value
+        # (for an ordered comparator, entry ind is selected by p[ind] && !p[ind-1] and the last by !p[n-2])
         n = len(counts)
-        inverse_comparator = comparator.replace("<",">") if "<" in comparator else comparator.replace(">","<")
-        inverse_comparator = inverse_comparator + "=" if len(inverse_comparator) == 1 else (inverse_comparator[0] if inverse_comparator != "==" else inverse_comparator)
+        num_preds = n if comparator == "==" or n == 1 else n - 1
+        preds = ["_sel" + str(self._select_count) + "_p" + str(ind) for ind in range(num_preds)]
+        self._select_count += 1
+        self.gen_add_code_line("bool " + ", ".join([preds[ind] + " = (" + loop_counter + " " + comparator + " " + counts[ind] + ")" \
+                                                    for ind in range(num_preds)]) + ";")
+        if num_preds == n:
+            terms = preds
+        else:
+            terms = [preds[0]] + ["(" + preds[ind] + " && !" + preds[ind-1] + ")" for ind in range(1, n-1)] + ["(!" + preds[n-2] + ")"]
         for tuple_i in range(len(select_tuples)):
-            branch_code = ""
-            for ind in range(n):
-                if ind == 0 or comparator == "==":
-                    if comparator == "==" and ind > 0:
-                        branch_code += " + "
-                    branch_code += "(" + loop_counter + " " + comparator + " " + counts[ind] + ")" 
-                elif ind < n-1:
-                    branch_code += " + (" + loop_counter + " " + comparator + " " + counts[ind] + " && " + loop_counter + " " + inverse_comparator + " " + counts[ind-1] + ")"
-                else:
-                    branch_code += " + (" + loop_counter + " " + inverse_comparator + " " + counts[ind-1] + ")"
-                branch_code += " * " + select_tuples[tuple_i][2][ind]
+            branch_code = " + ".join([terms[ind] + " * " + select_tuples[tuple_i][2][ind] for ind in range(n)])
             self.gen_add_code_line(dst_code[tuple_i] + " = " + branch_code + ";")
 
-def gen_kernel_load_inputs(self, name, stride, amount, use_thread_group = False, \
-                                 name2 = None, stride2 = 1, amount2 = 1, name3 = None, stride3 = 1, amount3 = 1):
-    self.gen_add_code_line("// load to shared mem")
-    self.gen_add_code_line("const T *d_" + name + "_k = &d_" + name + "[k*" + stride + "];")
-    self.gen_add_parallel_loop("ind",amount,use_thread_group)
-    self.gen_add_code_line("s_" + name + "[ind] = d_" + name + "_k[ind];")
-    self.gen_add_end_control_flow()
-    if name2 is not None:
-        self.gen_add_code_line("const T *d_" + name2 + "_k = &d_" + name2 + "[k*" + stride2 + "];")
-        self.gen_add_parallel_loop("ind",amount2,use_thread_group)
-        self.gen_add_code_line("s_" + name2 + "[ind] = d_" + name2 + "_k[ind];")
-        self.gen_add_end_control_flow()
-    if name3 is not None:
-        self.gen_add_code_line("const T *d_" + name3 + "_k = &d_" + name3 + "[k*" + stride3 + "];")
-        self.gen_add_parallel_loop("ind",amount3,use_thread_group)
-        self.gen_add_code_line("s_" + name3 + "[ind] = d_" + name3 + "_k[ind];")
-        self.gen_add_end_control_flow()
-    self.gen_add_sync(use_thread_group)
-
-def gen_kernel_save_result(self, store_to_name, stride, amount, use_thread_group = False, load_from_name = None):
-    if load_from_name is None:
-        load_from_name = "s_" + store_to_name
-    self.gen_add_code_line("// save down to global")
-    self.gen_add_code_line("T *d_" + store_to_name + "_k = &d_" + store_to_name + "[k*" + stride + "];")
-    self.gen_add_parallel_loop("ind",amount,use_thread_group)
-    self.gen_add_code_line("d_" + store_to_name + "_k[ind] = " + load_from_name + "[ind];")
+def _gen_add_async_copy_wait(self):
+    self.gen_add_code_line("__pipeline_commit();")
+    self.gen_add_code_line("__pipeline_wait_prior(0);")
+
+def _gen_add_fused_copy(self, copies, use_thread_group = False, async_copy = False, elem_type = "T"):
+    # copies is a list of (dst, src, amount); all of them share one parallel loop over the largest
+    # amount, with the shorter copies guarded by their own amount. With async_copy the global to shared
+    # copies are issued with cp.async and the caller has to commit and wait on them
+    amounts = [str(amount) for (dst, src, amount) in copies]
+    if len(set(amounts)) == 1:
+        bound = amounts[0]
+    elif all(amount.isdigit() for amount in amounts):
+        bound = max(amounts, key = int)
+    else:
+        # the amounts are only known to the C++ compiler so fall back to one loop per copy
+        for copy in copies:
+            _gen_add_fused_copy(self, [copy], use_thread_group, async_copy, elem_type)
+        return
+    self.gen_add_parallel_loop("ind", bound, use_thread_group)
+    for (dst, src, amount) in copies:
+        if async_copy:
+            code = "__pipeline_memcpy_async(&" + dst + "[ind], &" + src + "[ind], sizeof(" + elem_type + "));"
+        else:
+            code = dst + "[ind] = " + src + "[ind];"
+        if str(amount) != bound and int(amount) != int(bound):
+            code = "if(ind < " + str(amount) + "){" + code + "}"
+        self.gen_add_code_line(code)
     self.gen_add_end_control_flow()
-    self.gen_add_sync(use_thread_group)
+
+def _gen_add_vector_copy(self, copies, use_thread_group = False, async_copy = False, vector_width = 1):
+    # same as _gen_add_fused_copy but moves vector_width elements of T at a time as one 16 byte int4, followed
+    # by a scalar loop for the elements left over. Both pointers have to be 16 byte aligned
+    if vector_width == 1:
+        _gen_add_fused_copy(self, copies, use_thread_group, async_copy)
+        return
+    w = str(vector_width)
+    self.gen_add_code_line("static_assert(sizeof(T)*" + w + " == 16, \"vector_width elements of T must fill 16 bytes\");")
+    vector_copies = []
+    tail_copies = []
+    for (dst, src, amount) in copies:
+        amount = str(amount)
+        if amount.isdigit():
+            num_vectors = str(int(amount) // vector_width)
+            offset = str(int(amount) // vector_width * vector_width)
+            tail = str(int(amount) % vector_width)
+        else:
+            num_vectors = "(" + amount + ")/" + w
+            offset = num_vectors + "*" + w
+            tail = "(" + amount + ")%" + w
+        if num_vectors != "0":
+            vector_copies.append(("reinterpret_cast<int4 *>(" + dst + ")", "reinterpret_cast<const int4 *>(" + src + ")", num_vectors))
+        if tail != "0":
+            tail_copies.append(("(" + dst + " + " + offset + ")", "(" + src + " + " + offset + ")", tail))
+    if vector_copies:
+        _gen_add_fused_copy(self, vector_copies, use_thread_group, async_copy, "int4")
+    if tail_copies:
+        _gen_add_fused_copy(self, tail_copies, use_thread_group, async_copy)
+
+def _emit_copy_block(self, direction, tiles, use_thread_group = False, load_from_name = None, \
+                           emit_trailing_sync = True, vector_width = 1):
+    # direction is "load" (global d_<name> to shared s_<name>) or "save" (shared to global). tiles is a list of
+    # (name, amount, stride); a stride that is not None offsets the global pointer to &d_<name>[k*stride]
+    loading = direction == "load"
+    self.gen_add_code_line("// load to shared mem" if loading else "// save down to global")
+    copies = []
+    for (name, amount, stride) in tiles:
+        global_ptr = "d_" + name
+        if stride is not None:
+            global_ptr += "_k"
+            self.gen_add_code_line(("const T" if loading else "T") + " * __restrict__ " + global_ptr + \
+                                   " = &d_" + name + "[k*" + str(stride) + "];")
+        if loading:
+            copies.append(("s_" + name, global_ptr, amount))
+        else:
+            copies.append((global_ptr, load_from_name or "s_" + name, amount))
+    # with use_async_copy copy straight from global to shared memory with cp.async (needs cuda_pipeline.h)
+    async_copy = loading and self.use_async_copy
+    _gen_add_vector_copy(self, copies, use_thread_group, async_copy, vector_width)
+    if async_copy:
+        _gen_add_async_copy_wait(self)
+    if emit_trailing_sync:
+        self.gen_add_sync(use_thread_group)
+
+def gen_kernel_load_inputs(self, name, stride, amount, use_thread_group = False, \
+                                 name2 = None, stride2 = 1, amount2 = 1, name3 = None, stride3 = 1, amount3 = 1, \
+                                 emit_trailing_sync = True, vector_width = 1):
+    tiles = [(n, am, st) for (n, am, st) in ((name, amount, stride), (name2, amount2, stride2), (name3, amount3, stride3)) if n is not None]
+    _emit_copy_block(self, "load", tiles, use_thread_group, None, emit_trailing_sync, vector_width)
+
+def gen_kernel_save_result(self, store_to_name, stride, amount, use_thread_group = False, load_from_name = None, \
+                                 emit_trailing_sync = True, vector_width = 1):
+    _emit_copy_block(self, "save", [(store_to_name, amount, stride)], use_thread_group, load_from_name, emit_trailing_sync, vector_width)
 
 def gen_kernel_load_inputs_single_timing(self, name, amount, use_thread_group = False, \
-                                               name2 = None, amount2 = 1, name3 = None, amount3 = 1):
-    self.gen_add_code_line("// load to shared mem")
-    self.gen_add_parallel_loop("ind",amount,use_thread_group)
-    self.gen_add_code_line("s_" + name + "[ind] = d_" + name + "[ind];")
-    self.gen_add_end_control_flow()
-    if name2 is not None:
-        self.gen_add_parallel_loop("ind",amount2,use_thread_group)
-        self.gen_add_code_line("s_" + name2 + "[ind] = d_" + name2 + "[ind];")
-        self.gen_add_end_control_flow()
-    if name3 is not None:
-        self.gen_add_parallel_loop("ind",amount3,use_thread_group)
-        self.gen_add_code_line("s_" + name3 + "[ind] = d_" + name3 + "[ind];")
-        self.gen_add_end_control_flow()
-    self.gen_add_sync(use_thread_group)
-
-def gen_kernel_save_result_single_timing(self, store_to_name, amount, use_thread_group = False, load_from_name = None):
-    if load_from_name is None:
-        load_from_name = "s_" + store_to_name
-    self.gen_add_code_line("// save down to global")
-    self.gen_add_parallel_loop("ind",amount,use_thread_group)
-    self.gen_add_code_line("d_" + store_to_name + "[ind] = " + load_from_name + "[ind];")
-    self.gen_add_end_control_flow()
-    self.gen_add_sync(use_thread_group)
+                                               name2 = None, amount2 = 1, name3 = None, amount3 = 1, \
+                                               emit_trailing_sync = True, vector_width = 1):
+    tiles = [(n, am, None) for (n, am) in ((name, amount), (name2, amount2), (name3, amount3)) if n is not None]
+    _emit_copy_block(self, "load", tiles, use_thread_group, None, emit_trailing_sync, vector_width)
+
+def gen_kernel_save_result_single_timing(self, store_to_name, amount, use_thread_group = False, load_from_name = None, \
+                                               emit_trailing_sync = True, vector_width = 1):
+    _emit_copy_block(self, "save", [(store_to_name, amount, None)], use_thread_group, load_from_name, emit_trailing_sync, vector_width)
@@ -0,0 +1,119 @@
+import inspect
+
+import code_generation_helpers
+
+
+class StubGenerator:
+    pass
+
+
+# bind the public helpers by name, the way the generator class does
+for name, func in inspect.getmembers(code_generation_helpers, inspect.isfunction):
+    if func.__module__ == code_generation_helpers.__name__ and not name.startswith("_"):
+        setattr(StubGenerator, name, func)
+
+
+def make_generator():
+    gen = StubGenerator()
+    gen.gen_init_code()
+    return gen
+
+
+def test_var_in_list_collapses_runs():
+    gen = make_generator()
+    assert gen.gen_var_in_list("j", ["1", "2", "3", "7"]) == "((j >= 1 && j <= 3) || (j == 7))"
+    assert gen.gen_var_not_in_list("j", ["1", "2", "3", "7"]) == "((j < 1 || j > 3) && (j != 7))"
+
+
+def test_var_in_list_short_runs_stay_equalities():
+    gen = make_generator()
+    assert gen.gen_var_in_list("j", ["4", "3"]) == "((j == 3) || (j == 4))"
+    assert gen.gen_var_in_list("j", ["4"]) == "(j == 4)"
+
+
+def test_var_in_list_negative_options():
+    gen = make_generator()
+    assert gen.gen_var_in_list("j", ["-2", "-1", "0", "5"]) == "((j >= -2 && j <= 0) || (j == 5))"
+    assert gen.gen_var_not_in_list("j", ["-2", "-1", "0", "5"]) == "((j < -2 || j > 0) && (j != 5))"
+
+
+def test_var_in_list_keeps_non_decimal_options():
+    gen = make_generator()
+    # C++ reads these as octal, so they must not be collapsed as decimal values
+    assert gen.gen_var_in_list("j", ["010", "011", "012"]) == "((j == 010) || (j == 011) || (j == 012))"
+    assert gen.gen_var_not_in_list("j", ["010", "011", "012"]) == "((j != 010) && (j != 011) && (j != 012))"
+    assert gen.gen_var_in_list("j", ["1_0", "2", "3"]) == "((j == 1_0) || (j == 2) || (j == 3))"
+    assert gen.gen_var_in_list("j", ["a", "b"]) == "((j == a) || (j == b))"
+
+
+def test_var_in_list_switches_over_single_values_only():
+    gen = make_generator()
+    options = [str(i) for i in range(200)] + [str(i) for i in range(300, 320, 2)]
+    code = gen.gen_var_in_list("j", options)
+    assert code.startswith("((j >= 0 && j <= 199) || ([&]{switch(j){")
+    assert code.count("case ") == 10
+    assert "case 150:" not in code
+    code = gen.gen_var_not_in_list("j", options)
+    assert code.startswith("((j < 0 || j > 199) && (!([&]{switch(j){")
+    assert code.count("case ") == 10
+
+
+def test_var_in_list_few_single_values_do_not_switch():
+    gen = make_generator()
+    options = [str(i) for i in range(0, 14, 2)]
+    assert "switch" not in gen.gen_var_in_list("j", options)
+    assert "switch" in gen.gen_var_in_list("j", options + ["14"])
+
+
+def test_parallel_loop_base_reused_in_nested_blocks():
+    gen = make_generator()
+    gen.gen_add_code_line("__device__ void f(){", True)
+    gen.gen_add_parallel_loop("i", "6")
+    gen.gen_add_parallel_loop("j", "6")
+    gen.gen_add_end_control_flow()
+    gen.gen_add_end_control_flow()
+    gen.gen_add_parallel_loop("k", "6")
+    gen.gen_add_end_control_flow()
+    gen.gen_add_end_function()
+    code = gen.get_code()
+    assert code.count("const int _thr_base") == 1
+    assert code.count("const int _thr_stride") == 1
+    assert "for(int j = _thr_base; j < 6; j += _thr_stride){" in code
+
+
+def test_parallel_loop_base_redeclared_after_block_closes():
+    gen = make_generator()
+    gen.gen_add_code_line("__device__ void f(){", True)
+    gen.gen_add_serial_ops()
+    gen.gen_add_parallel_loop("i", "6")
+    gen.gen_add_end_control_flow()
+    gen.gen_add_end_control_flow()
+    gen.gen_add_parallel_loop("i", "6")
+    gen.gen_add_end_control_flow()
+    gen.gen_add_end_function()
+    gen.gen_add_code_line("__device__ void g(){", True)
+    gen.gen_add_parallel_loop("i", "6")
+    gen.gen_add_end_control_flow()
+    gen.gen_add_end_function()
+    lines = gen.get_code().splitlines()
+    declarations = [line for line in lines if "const int _thr_base" in line]
+    # inside the serial block, after it closes, and in the second function
+    assert declarations == ["        const int _thr_base = threadIdx.x + threadIdx.y*blockDim.x;",
+                            "    const int _thr_base = threadIdx.x + threadIdx.y*blockDim.x;",
+                            "    const int _thr_base = threadIdx.x + threadIdx.y*blockDim.x;"]
+
+
+def test_parallel_loop_bases_tracked_per_kind():
+    gen = make_generator()
+    gen.gen_add_code_line("__global__ void f(){", True)
+    gen.gen_add_parallel_loop("i", "6", block_level = True)
+    gen.gen_add_end_control_flow()
+    gen.gen_add_parallel_loop("i", "6")
+    gen.gen_add_end_control_flow()
+    gen.gen_add_parallel_loop("i", "6", use_thread_group = True)
+    gen.gen_add_end_control_flow()
+    gen.gen_add_end_function()
+    code = gen.get_code()
+    assert code.count("const int _grid_base") == 1
+    assert code.count("const int _thr_base") == 1
+    assert "for(int i = tgrp.thread_rank(); i < 6; i += tgrp.size()){" in code